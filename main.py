@@ -7,9 +7,14 @@ import difflib
 import asyncio
 from duckduckgo_search import AsyncDDGS
 import json
-from pygments import highlight
-from pygments.lexers import get_lexer_by_name
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pygments import highlight, format as format_tokens
+from pygments.lexers import get_lexer_by_name, TextLexer
 from pygments.formatters import TerminalFormatter
+from pygments.util import ClassNotFound
+from pygments.token import Token
 from rich.console import Console
 from rich.table import Table
 import base64
@@ -24,7 +29,20 @@ from prompt_toolkit.formatted_text import HTML
 from prompt_toolkit.completion import WordCompleter
 from prompt_toolkit.application.current import get_app
 
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError:  # Not on Linux or not installed, fall back to mtime polling
+    INotify = None
+
+try:
+    import tiktoken
+except ImportError:  # Rough estimate of ~4 characters per token instead
+    tiktoken = None
+token_encoding = None  # Loaded on first use, it may need a download
+
 is_diff_on = True
+EDIT_MODES = ("sequential", "pipelined", "direct")
+edit_mode = "sequential"
 
 init(autoreset=True)
 load_dotenv()
@@ -33,8 +51,21 @@ client = OpenAI(
     api_key=os.getenv("OPENROUTER_API_KEY"),
 )
 
+def get_int_env(name):
+    """Read an integer setting from the environment, treating missing or bad values as 0."""
+    value = os.getenv(name, "").strip()
+    try:
+        return int(value) if value else 0
+    except ValueError:
+        print(f"{Fore.YELLOW}⚠️ Ignoring {name}={value!r}, expected a whole number of tokens.{Style.RESET_ALL}")
+        return 0
+
 DEFAULT_MODEL = "openai/o1-mini-2024-09-12"
 EDITOR_MODEL = "anthropic/claude-3.5-sonnet"
+# Prompt budgets in tokens, 0 disables the check
+PROMPT_TOKEN_SOFT_LIMIT = get_int_env("PROMPT_TOKEN_SOFT_LIMIT")
+PROMPT_TOKEN_HARD_LIMIT = get_int_env("PROMPT_TOKEN_HARD_LIMIT")
+SESSION_TOKEN_BUDGET = get_int_env("SESSION_TOKEN_BUDGET")
 # Other common models:
 # "openai/gpt-4o-2024-08-06"
 # "meta-llama/llama-3.1-405b-instruct"
@@ -77,8 +108,17 @@ file_templates = {
 }
 undo_history = {}
 stored_images = {}
+file_snapshots = {}  # filepath -> (mtime, content) last seen by the model
+file_watcher = None
+watched_dirs = {}  # inotify watch descriptor -> directory
+changed_paths = set()
+lexer_cache = {}
+terminal_formatter = TerminalFormatter()
+usage_log = []  # One record per model call in this session
+current_command = "chat"
+edit_latencies = {}  # edit mode -> end-to-end seconds of each /edit
 command_history = FileHistory('.aiconsole_history.txt')
-commands = WordCompleter(['/add', '/edit', '/new', '/search', '/image', '/clear', '/reset', '/diff', '/history', '/save', '/load', '/undo', '/help', '/model', '/change_model', '/show', 'exit'], ignore_case=True)
+commands = WordCompleter(['/add', '/edit', '/new', '/search', '/image', '/clear', '/reset', '/diff', '/history', '/save', '/load', '/undo', '/help', '/model', '/change_model', '/show', '/usage', '/edit_mode', 'exit'], ignore_case=True)
 session = PromptSession(history=command_history)
 
 async def get_input_async(message):
@@ -215,18 +255,188 @@ def clear_console():
 def print_colored(text, color=Fore.WHITE, style=Style.NORMAL, end='\n'):
     print(f"{style}{color}{text}{Style.RESET_ALL}", end=end)
 
+def get_cached_lexer(language):
+    """Return a lexer for language, building each one only once."""
+    language = language.lower()
+    if language not in lexer_cache:
+        # Keep blank lines so token line numbers match the source lines
+        try:
+            lexer_cache[language] = get_lexer_by_name(language, stripnl=False)
+        except ClassNotFound:
+            lexer_cache[language] = TextLexer(stripnl=False)
+    return lexer_cache[language]
+
+def is_fence(line):
+    return line.lstrip().startswith("```")
+
+class StreamingHighlighter:
+    """Print streamed markdown, highlighting fenced code one completed line at a time.
+
+    Each new code line is lexed together with the earlier lines of any string or
+    block comment that is still open, so docstrings keep their context while a
+    line's cost stays independent of the block's length. Only the new line's
+    tokens are printed.
+    """
+
+    MAX_OPEN_LINES = 200  # Give up on context for absurdly long open constructs
+
+    def __init__(self):
+        self.line = ""        # Current, not yet finished line
+        self.printed = 0      # How much of self.line is already on screen
+        self.in_code = False
+        self.language = None
+        self.code_lines = []  # Completed code lines since the lexer was last in a clean state
+
+    def feed(self, text):
+        self.line += text
+        while '\n' in self.line:
+            line, self.line = self.line.split('\n', 1)
+            self.render_line(line)
+            self.printed = 0
+
+        # Prose streams as it arrives, unless the line might still turn into a fence.
+        # Code lines wait for their newline so each one is highlighted exactly once.
+        if not self.in_code and not "```".startswith(self.line.lstrip()[:3]):
+            print_colored(self.line[self.printed:], end="")
+            self.printed = len(self.line)
+
+    def render_line(self, line):
+        if is_fence(line) and self.printed == 0:
+            if self.in_code:
+                self.in_code, self.language = False, None
+            else:
+                self.in_code = True
+                self.language = line.strip()[3:].strip() or None
+            self.code_lines = []
+            print_colored(line, Fore.BLUE)
+        elif self.in_code:
+            self.print_code(line)
+        else:
+            print_colored(line[self.printed:])
+
+    def print_code(self, line):
+        if not self.language:
+            print_colored(line)
+            return
+
+        self.code_lines.append(line)
+        source = '\n'.join(self.code_lines) + '\n'
+        last_line = len(self.code_lines) - 1
+        line_number, tokens, still_open = 0, [], False
+        for token_type, value in get_cached_lexer(self.language).get_tokens(source):
+            for idx, part in enumerate(value.split('\n')):
+                if idx:
+                    line_number += 1
+                if line_number == last_line and part:
+                    tokens.append((token_type, part))
+            if '\n' in value:
+                # The line's newline inside a string or block comment means it continues
+                still_open = (token_type in Token.Literal.String or token_type in Token.Comment) \
+                    and token_type not in Token.Comment.Single
+        tokens.append((Token.Text, '\n'))
+        print(format_tokens(tokens, terminal_formatter), end="")
+
+        if not still_open or len(self.code_lines) >= self.MAX_OPEN_LINES:
+            self.code_lines = []
+
+    def flush(self):
+        """Print whatever is left once the stream ends."""
+        if self.line:
+            self.render_line(self.line)
+        self.line, self.printed = "", 0
+        self.in_code, self.language = False, None
+        self.code_lines = []
+
+def estimate_tokens(text):
+    global tiktoken, token_encoding
+    if tiktoken is not None and token_encoding is None:
+        try:
+            token_encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:  # e.g. offline and the encoding isn't cached yet
+            tiktoken = None
+    if token_encoding is not None:
+        return len(token_encoding.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+def estimate_prompt_tokens(messages):
+    total = 0
+    for message in messages:
+        content = message['content']
+        if isinstance(content, list):  # Multimodal message, only count the text parts
+            content = " ".join(part.get('text', '') for part in content)
+        total += estimate_tokens(content) + 4  # Per-message formatting overhead
+    return total
+
+def get_session_tokens():
+    return sum(record['prompt_tokens'] + record['completion_tokens'] for record in usage_log)
+
+def check_prompt_budget(messages, model):
+    """Warn about or refuse a prompt that exceeds the configured budgets."""
+    prompt_tokens = estimate_prompt_tokens(messages)
+    if PROMPT_TOKEN_HARD_LIMIT and prompt_tokens > PROMPT_TOKEN_HARD_LIMIT:
+        raise ValueError(
+            f"prompt for {model} is ~{prompt_tokens} tokens, over the hard limit of {PROMPT_TOKEN_HARD_LIMIT}. "
+            "Use /reset to shrink the context."
+        )
+    if SESSION_TOKEN_BUDGET and get_session_tokens() + prompt_tokens > SESSION_TOKEN_BUDGET:
+        raise ValueError(f"session token budget of {SESSION_TOKEN_BUDGET} would be exceeded.")
+    if PROMPT_TOKEN_SOFT_LIMIT and prompt_tokens > PROMPT_TOKEN_SOFT_LIMIT:
+        print_colored(
+            f"⚠️ Prompt for {model} is ~{prompt_tokens} tokens (soft limit {PROMPT_TOKEN_SOFT_LIMIT}).",
+            Fore.YELLOW,
+        )
+    return prompt_tokens
+
+def record_usage(model, usage, prompt_estimate, completion_text):
+    """Log the usage reported by the API, or a local estimate when it has none."""
+    record = {
+        "command": current_command,
+        "model": model,
+        "timestamp": time.time(),
+    }
+    if usage is not None:
+        record["prompt_tokens"] = usage.prompt_tokens
+        record["completion_tokens"] = usage.completion_tokens
+        record["cost"] = getattr(usage, "cost", None)  # Only sent by OpenRouter
+        record["estimated"] = False
+    else:
+        record["prompt_tokens"] = prompt_estimate
+        record["completion_tokens"] = estimate_tokens(completion_text)
+        record["cost"] = None
+        record["estimated"] = True
+    usage_log.append(record)
+
+def stream_completion(messages, model):
+    """Yield the streamed text of a completion, recording its token usage."""
+    prompt_estimate = check_prompt_budget(messages, model)
+    stream = client.chat.completions.create(
+        model=model,
+        messages=messages,
+        stream=True,
+        stream_options={"include_usage": True},
+        extra_body={"usage": {"include": True}},
+    )
+    completion_text = ""
+    usage = None
+    try:
+        for chunk in stream:
+            if getattr(chunk, "usage", None) is not None:
+                usage = chunk.usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                completion_text += chunk.choices[0].delta.content
+                yield chunk.choices[0].delta.content
+    finally:
+        # Streams that fail or are abandoned partway are still billed
+        record_usage(model, usage, prompt_estimate, completion_text)
+
 def get_streaming_response(messages, model):
     try:
-        stream = client.chat.completions.create(
-            model=model,
-            messages=messages,
-            stream=True,
-        )
         full_response = ""
-        for chunk in stream:
-            if chunk.choices[0].delta.content is not None:
-                print_colored(chunk.choices[0].delta.content, end="")
-                full_response += chunk.choices[0].delta.content
+        renderer = StreamingHighlighter()
+        for content in stream_completion(messages, model):
+            renderer.feed(content)
+            full_response += content
+        renderer.flush()
         return full_response.strip()
     except Exception as e:
         print_colored(f"Error in streaming response: {e}", Fore.RED)
@@ -268,6 +478,98 @@ def is_text_file(file_path, sample_size=8192, text_characters=set(bytes(range(32
     except IOError:
         return False
 
+def get_file_watcher():
+    """Lazily create the inotify watcher, or None when only polling is available."""
+    global file_watcher, INotify
+    if file_watcher is None and INotify is not None:
+        try:
+            file_watcher = INotify()
+        except OSError:
+            INotify = None  # inotify limits reached or unsupported, poll instead
+    return file_watcher
+
+def watch_file(filepath, content):
+    """Remember what the model has seen of filepath and watch it for changes."""
+    try:
+        mtime = os.path.getmtime(filepath)
+    except OSError:
+        mtime = None
+    file_snapshots[filepath] = (mtime, content)
+
+    watcher = get_file_watcher()
+    if watcher is None:
+        return
+    # Watch the directory so editors that save via rename are still seen
+    directory = os.path.dirname(os.path.abspath(filepath))
+    if directory in watched_dirs.values():
+        return
+    try:
+        mask = inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO | inotify_flags.CREATE | inotify_flags.DELETE
+        watched_dirs[watcher.add_watch(directory, mask)] = directory
+    except OSError:
+        pass  # The mtime check in get_changed_files still covers this file
+
+def unwatch_all_files():
+    global file_watcher
+    file_snapshots.clear()
+    changed_paths.clear()
+    watched_dirs.clear()
+    if file_watcher is not None:
+        file_watcher.close()
+        file_watcher = None
+
+def get_changed_files():
+    """Return the watched files that may differ from their last snapshot."""
+    watcher = get_file_watcher()
+    if watcher is not None:
+        for event in watcher.read(timeout=0):
+            directory = watched_dirs.get(event.wd)
+            if directory and event.name:
+                changed_paths.add(os.path.join(directory, event.name))
+
+    changed = []
+    for filepath, (mtime, _) in file_snapshots.items():
+        if os.path.abspath(filepath) in changed_paths:
+            changed.append(filepath)
+            continue
+        try:
+            if os.path.getmtime(filepath) != mtime:
+                changed.append(filepath)
+        except OSError:
+            if mtime is not None:  # File was deleted since the snapshot
+                changed.append(filepath)
+    changed_paths.clear()
+    return changed
+
+def refresh_added_files(chat_history):
+    """Send the model a compact diff of added files that changed since it last saw them."""
+    updates = []
+    for filepath in get_changed_files():
+        old_content = file_snapshots[filepath][1]
+        if not os.path.isfile(filepath):
+            updates.append(f"File {filepath} has been deleted.")
+            del file_snapshots[filepath]
+            added_files[:] = [fp for fp in added_files if fp != filepath]  # /add it again if it comes back
+            continue
+        new_content = read_file_content(filepath)
+        if new_content.startswith("❌"):
+            continue
+        watch_file(filepath, new_content)
+        diff = '\n'.join(difflib.unified_diff(
+            old_content.splitlines(), new_content.splitlines(),
+            fromfile=f"a/{filepath}", tofile=f"b/{filepath}", lineterm='', n=1
+        ))
+        if diff:
+            updates.append(diff)
+
+    if updates:
+        update_context = "The following added files changed since you last saw them:\n"
+        update_context += "```diff\n" + "\n".join(updates) + "\n```"
+        chat_history.append({"role": "user", "content": update_context})
+        print_colored(f"🔄 Refreshed {len(updates)} changed files in context.", Fore.CYAN)
+
+    return chat_history
+
 async def handle_add_command(chat_history, *paths):
     global added_files
     contents = []
@@ -279,6 +581,7 @@ async def handle_add_command(chat_history, *paths):
             if not content.startswith("❌"):
                 contents.append((path, content))
                 added_files.append(path)
+                watch_file(path, content)
 
         elif os.path.isdir(path):  # Directory handling
             print_colored(f"📁 Processing folder: {path}", Fore.CYAN)
@@ -289,6 +592,7 @@ async def handle_add_command(chat_history, *paths):
                     if not content.startswith("❌"):
                         contents.append((item_path, content))
                         added_files.append(item_path)
+                        watch_file(item_path, content)
 
         else:
             print_colored(f"❌ '{path}' is neither a valid file nor folder.", Fore.RED)
@@ -305,97 +609,263 @@ async def handle_add_command(chat_history, *paths):
 
     return chat_history
 
-async def handle_edit_command(default_chat_history, editor_chat_history, filepaths):
-    all_contents = [read_file_content(fp) for fp in filepaths]
-    valid_files, valid_contents = [], []
+def build_edit_message(filepath, content, instructions):
+    return f"""
+            Original code:
 
-    for filepath, content in zip(filepaths, all_contents):
-        if content.startswith("❌"):
-            print_colored(content, Fore.RED)
-        else:
-            valid_files.append(filepath)
-            valid_contents.append(content)
+            {content}
 
-    if not valid_files:
-        print_colored("❌ No valid files to edit.", Fore.YELLOW)
-        return default_chat_history, editor_chat_history
+            Instructions: {instructions}
 
-    user_request = await get_input_async(f"What would you like to change in {', '.join(valid_files)}?")
+            Follow only instructions applicable to {filepath}. Output ONLY the new code. No explanations. DO NOT ADD ANYTHING ELSE. no type of file at the beginning of the file like ```python etq. no ``` at the end of the file.
+            """
 
-    instructions_prompt = "For these files:\n"
-    instructions_prompt += "\n".join([f"File: {fp}\n```\n{content}\n```\n" for fp, content in zip(valid_files, valid_contents)])
-    instructions_prompt += f"User wants: {user_request}\nProvide LINE-BY-LINE edit instructions for ALL files. Number each instruction and specify which file it applies to.\n"
+def generate_edit(messages, current_content, stream_output=True):
+    """Run the editor model over current_content and return the edited file."""
+    lines = current_content.split('\n')
+    buffer = ""
+    edited_lines = lines.copy()  # Create a copy to store edited lines
+    line_index = 0
+
+    for content in stream_completion(messages, EDITOR_MODEL):
+        if stream_output:
+            print_colored(content, end="")
+        buffer += content
+
+        while '\n' in buffer:
+            line, buffer = buffer.split('\n', 1)
+            if line_index < len(edited_lines):
+                edited_lines[line_index] = line
+                if stream_output:
+                    print_colored(f"✏️ Updated Line {line_index+1}: {line[:50]}...", Fore.CYAN)
+                line_index += 1
+            else:
+                edited_lines.append(line)
+                if stream_output:
+                    print_colored(f"➕ NEW Line {line_index+1}: {line[:50]}...", Fore.YELLOW)
+                line_index += 1
 
-    default_chat_history.append({"role": "user", "content": instructions_prompt})
-    default_instructions = get_streaming_response(default_chat_history, DEFAULT_MODEL)
-    default_chat_history.append({"role": "assistant", "content": default_instructions})
+    return '\n'.join(edited_lines)
 
-    print_colored("\n" + "=" * 50, Fore.MAGENTA)
+def save_edit(filepath, current_content, result):
+    undo_history[filepath] = current_content   # Store undo
 
+    if is_diff_on:
+        display_diff(current_content, result)  # Show final diff if it's on
+
+    # Write the changes to the file only after the entire editing process
+    if write_file_content(filepath, result):
+        print_colored(f"✅ {filepath} successfully edited and saved!", Fore.GREEN)
+    else:
+        print_colored(f"❌ Failed to save changes to {filepath}", Fore.RED)
+
+def mark_files_seen(filepaths, contents):
+    """Move the snapshots of /add-ed files to the content the planner was just sent."""
+    for filepath, content in zip(filepaths, contents):
+        if filepath in file_snapshots:
+            watch_file(filepath, content)
+
+def find_file_header(line, filepaths):
+    """Return the file a planner line introduces, e.g. '**File: main.py**', if any."""
+    text = re.sub(r'^[\s#>*+-]*', '', line)  # Headings, quotes, list markers and bold
+    text = re.sub(r'^\d+[.)]\s*', '', text)
+    label = re.match(r'file(\s*\d+)?\s*:\s*', text, re.I)
+    if label:
+        text = text[label.end():]
+    text = text.lstrip(' *`')
+    # Longest paths first, and allow trailing text such as '** (2 changes)'
+    for filepath in sorted(filepaths, key=len, reverse=True):
+        for name in (filepath, os.path.basename(filepath)):
+            if re.match(re.escape(name) + r'(?![\w./-])', text):
+                return filepath
+    return None
+
+def report_edit_latency(mode, start_time):
+    elapsed = time.perf_counter() - start_time
+    edit_latencies.setdefault(mode, []).append(elapsed)
+    summary = ", ".join(
+        f"{name}: {sum(times) / len(times):.1f}s avg over {len(times)}" for name, times in edit_latencies.items()
+    )
+    print_colored(f"⏱️ Edit took {elapsed:.1f}s in {mode} mode ({summary})", Fore.CYAN)
+
+def run_sequential_edit(editor_chat_history, valid_files, valid_contents, instructions):
     for idx, (filepath, content) in enumerate(zip(valid_files, valid_contents), 1):
         try:
             print_colored(f"📝 EDITING {filepath} ({idx}/{len(valid_files)}):", Fore.BLUE)
 
-            edit_message = f"""
-            Original code:
-
-            {content}
-
-            Instructions: {default_instructions}
-
-            Follow only instructions applicable to {filepath}. Output ONLY the new code. No explanations. DO NOT ADD ANYTHING ELSE. no type of file at the beginning of the file like ```python etq. no ``` at the end of the file.
-            """
-
-            editor_chat_history.append({"role": "user", "content": edit_message})
+            editor_chat_history.append({"role": "user", "content": build_edit_message(filepath, content, instructions)})
 
             current_content = read_file_content(filepath)  # Read fresh
             if current_content.startswith("❌"):
-                return default_chat_history, editor_chat_history
-
-            lines = current_content.split('\n')
-            buffer = ""
-            edited_lines = lines.copy()  # Create a copy to store edited lines
-            line_index = 0
-
-            for chunk in client.chat.completions.create(
-                model=EDITOR_MODEL,
-                messages=editor_chat_history,
-                stream=True,
-            ):
-                if chunk.choices[0].delta.content:
-                    content = chunk.choices[0].delta.content
-                    print_colored(content, end="")
-                    buffer += content
-
-                    while '\n' in buffer:
-                        line, buffer = buffer.split('\n', 1)
-                        if line_index < len(edited_lines):
-                            edited_lines[line_index] = line
-                            print_colored(f"✏️ Updated Line {line_index+1}: {line[:50]}...", Fore.CYAN)
-                            line_index += 1
-                        else:
-                            edited_lines.append(line)
-                            print_colored(f"➕ NEW Line {line_index+1}: {line[:50]}...", Fore.YELLOW)
-                            line_index += 1
-
-            result = '\n'.join(edited_lines)
-            undo_history[filepath] = current_content   # Store undo
+                return editor_chat_history
+
+            result = generate_edit(editor_chat_history, current_content)
             editor_chat_history.append({"role": "assistant", "content": result})
+            save_edit(filepath, current_content, result)
 
-            if is_diff_on:
-                display_diff(current_content, result)  # Show final diff if it's on
+            print_colored("=" * 50, Fore.MAGENTA)
+        except Exception as e:
+            print_colored(f"❌ Error editing {filepath}: {e}", Fore.RED)
 
-            # Write the changes to the file only after the entire editing process
-            if write_file_content(filepath, result):
-                print_colored(f"✅ {filepath} successfully edited and saved!", Fore.GREEN)
+    return editor_chat_history
+
+def run_pipelined_edit(default_chat_history, editor_chat_history, valid_files, valid_contents):
+    """Stream the planner and start each file's editor as soon as its instructions are complete."""
+    contents = dict(zip(valid_files, valid_contents))
+    preamble, sections = "", {}
+    current_file, pending_line, full_response = None, "", ""
+    planner_failed = False
+    current_contents, edit_messages, futures = {}, {}, {}
+    renderer = StreamingHighlighter()
+
+    with ThreadPoolExecutor(max_workers=len(valid_files)) as executor:
+        def start_editor(filepath, instructions):
+            current_contents[filepath] = read_file_content(filepath)  # Read fresh
+            if current_contents[filepath].startswith("❌"):
+                print_colored(current_contents[filepath], Fore.RED)
+                return
+            edit_messages[filepath] = {"role": "user", "content": build_edit_message(filepath, contents[filepath], instructions)}
+            futures[filepath] = executor.submit(
+                generate_edit, editor_chat_history + [edit_messages[filepath]], current_contents[filepath], False
+            )
+            print_colored(f"🚀 Started editing {filepath} while planning continues", Fore.CYAN)
+
+        def handle_planner_line(line):
+            nonlocal current_file, preamble
+            header = find_file_header(line, valid_files)
+            if header and header != current_file:
+                # A new file heading means the previous file's instructions are done
+                if current_file and current_file not in futures:
+                    start_editor(current_file, preamble + sections[current_file])
+                if header in futures:
+                    print_colored(f"⚠️ Planner returned to {header} after its edit started", Fore.YELLOW)
+                current_file = header
+            if current_file:
+                sections[current_file] = sections.get(current_file, "") + line + "\n"
             else:
-                print_colored(f"❌ Failed to save changes to {filepath}", Fore.RED)
+                preamble += line + "\n"
 
-            print_colored("=" * 50, Fore.MAGENTA)
+        try:
+            for content in stream_completion(default_chat_history, DEFAULT_MODEL):
+                renderer.feed(content)
+                full_response += content
+                pending_line += content
+                while '\n' in pending_line:
+                    line, pending_line = pending_line.split('\n', 1)
+                    handle_planner_line(line)
+            renderer.flush()
+            if pending_line:
+                handle_planner_line(pending_line)
         except Exception as e:
-            print_colored(f"❌ Error editing {filepath}: {e}", Fore.RED)
+            print_colored(f"Error in streaming response: {e}", Fore.RED)
+            planner_failed = True  # Only the files whose instructions were complete get edited
+
+        full_response = full_response.strip()
+        if full_response:
+            # Before any edit is saved, so the saved edits show up in the next refresh diff
+            mark_files_seen(valid_files, valid_contents)
+        if full_response and not planner_failed:
+            # Files without a heading of their own get the whole plan, as in sequential mode
+            for filepath in valid_files:
+                if filepath in futures:
+                    continue
+                if filepath not in sections:
+                    print_colored(f"ℹ️ No heading found for {filepath}, editing it with the full plan", Fore.YELLOW)
+                start_editor(filepath, preamble + sections[filepath] if filepath in sections else full_response)
+
+        print_colored("\n" + "=" * 50, Fore.MAGENTA)
+
+        for idx, filepath in enumerate(valid_files, 1):
+            if filepath not in futures:
+                continue
+            try:
+                print_colored(f"📝 EDITED {filepath} ({idx}/{len(valid_files)}):", Fore.BLUE)
+                result = futures[filepath].result()
+                editor_chat_history.append(edit_messages[filepath])
+                editor_chat_history.append({"role": "assistant", "content": result})
+                save_edit(filepath, current_contents[filepath], result)
+                print_colored("=" * 50, Fore.MAGENTA)
+            except Exception as e:
+                print_colored(f"❌ Error editing {filepath}: {e}", Fore.RED)
 
-    return default_chat_history, editor_chat_history
+    if planner_failed and full_response:
+        full_response += "\n\n[Plan truncated: the planner stream failed before it finished.]"
+    return full_response, editor_chat_history
+
+def run_direct_edit(editor_chat_history, filepath, content, user_request):
+    """Skip the planner and hand the user's request straight to the editor model."""
+    return run_sequential_edit(editor_chat_history, [filepath], [content], user_request)
+
+async def handle_edit_command(default_chat_history, editor_chat_history, filepaths):
+    all_contents = [read_file_content(fp) for fp in filepaths]
+    valid_files, valid_contents = [], []
+
+    for filepath, content in zip(filepaths, all_contents):
+        if content.startswith("❌"):
+            print_colored(content, Fore.RED)
+        else:
+            valid_files.append(filepath)
+            valid_contents.append(content)
+
+    if not valid_files:
+        print_colored("❌ No valid files to edit.", Fore.YELLOW)
+        return default_chat_history, editor_chat_history
+
+    user_request = await get_input_async(f"What would you like to change in {', '.join(valid_files)}?")
+    start_time = time.perf_counter()
+
+    mode = edit_mode
+    if mode == "direct" and len(valid_files) > 1:
+        print_colored("ℹ️ Direct mode only handles a single file, using pipelined mode.", Fore.YELLOW)
+        mode = "pipelined"
+
+    try:
+        if mode == "direct":
+            print_colored("\n" + "=" * 50, Fore.MAGENTA)
+            editor_chat_history = run_direct_edit(editor_chat_history, valid_files[0], valid_contents[0], user_request)
+            return default_chat_history, editor_chat_history
+
+        instructions_prompt = "For these files:\n"
+        instructions_prompt += "\n".join([f"File: {fp}\n```\n{content}\n```\n" for fp, content in zip(valid_files, valid_contents)])
+        instructions_prompt += f"User wants: {user_request}\nProvide LINE-BY-LINE edit instructions for ALL files. Number each instruction and specify which file it applies to.\n"
+        if mode == "pipelined":
+            instructions_prompt += "Group the instructions by file: start each group with a line 'File: <path>' and finish all instructions for one file before starting the next.\n"
+
+        default_chat_history = refresh_added_files(default_chat_history)
+        default_chat_history.append({"role": "user", "content": instructions_prompt})
+
+        if mode == "pipelined":
+            default_instructions, editor_chat_history = run_pipelined_edit(
+                default_chat_history, editor_chat_history, valid_files, valid_contents
+            )
+        else:
+            default_instructions = get_streaming_response(default_chat_history, DEFAULT_MODEL)
+
+        if not default_instructions:
+            print_colored("❌ No edit instructions were generated.", Fore.RED)
+            default_chat_history.pop()
+            return default_chat_history, editor_chat_history
+        default_chat_history.append({"role": "assistant", "content": default_instructions})
+
+        if mode == "sequential":
+            mark_files_seen(valid_files, valid_contents)
+            print_colored("\n" + "=" * 50, Fore.MAGENTA)
+            editor_chat_history = run_sequential_edit(editor_chat_history, valid_files, valid_contents, default_instructions)
+
+        return default_chat_history, editor_chat_history
+    finally:
+        report_edit_latency(mode, start_time)
+
+async def handle_edit_mode_command(mode=""):
+    global edit_mode
+    if not mode:
+        print_colored(f"Current edit mode: {edit_mode}", Fore.CYAN)
+        mode = (await get_input_async(f"Enter edit mode ({', '.join(EDIT_MODES)}):")).lower()
+    if mode not in EDIT_MODES:
+        print_colored(f"❌ Unknown edit mode '{mode}'. Choose one of: {', '.join(EDIT_MODES)}", Fore.RED)
+        return
+    edit_mode = mode
+    print_colored(f"Edit mode changed to: {edit_mode}", Fore.GREEN)
 
 async def handle_new_command(default_chat_history, editor_chat_history, filepaths):
     if not filepaths:
@@ -433,6 +903,7 @@ async def handle_clear_command():
 
     if added_files:
         added_files.clear()
+        unwatch_all_files()
         cleared_something = True
         print_colored("✅ Cleared memory of added files.", Fore.GREEN)
 
@@ -456,6 +927,7 @@ async def handle_reset_command(default_chat_history, editor_chat_history):
     default_chat_history.clear()
     editor_chat_history.clear()
     added_files.clear()
+    unwatch_all_files()
     stored_searches.clear()
     stored_images.clear()
 
@@ -486,11 +958,16 @@ def handle_history_command(chat_history):
         content = message['content'][:100] + "..." if len(message['content']) > 100 else message['content']
         print_colored(f"{idx}. {role}: {content}", Fore.CYAN)
 
+def get_usage_filename(filename):
+    return f"{os.path.splitext(filename)[0]}.usage.json"
+
 async def handle_save_command(chat_history):
     filename = await get_input_async("Enter filename to save chat history:")
     try:
         with open(filename, 'w') as f:
             json.dump(chat_history, f)
+        with open(get_usage_filename(filename), 'w') as f:
+            json.dump(usage_log, f)
         print_colored(f"✅ Chat history saved to {filename}", Fore.GREEN)
     except IOError as e:
         print_colored(f"❌ Error saving chat history: {e}", Fore.RED)
@@ -500,6 +977,9 @@ async def handle_load_command():
     try:
         with open(filename, 'r') as f:
             loaded_history = json.load(f)
+        if os.path.isfile(get_usage_filename(filename)):
+            with open(get_usage_filename(filename), 'r') as f:
+                usage_log[:] = json.load(f)
         print_colored(f"✅ Chat history loaded from {filename}", Fore.GREEN)
         return loaded_history
     except IOError as e:
@@ -520,9 +1000,44 @@ async def handle_undo_command(filepath):
     else:
         print_colored(f"❌ No undo history for {filepath}", Fore.RED)
 
+def handle_usage_command():
+    if not usage_log:
+        print_colored("ℹ️ No model calls recorded yet.", Fore.YELLOW)
+        return
+
+    totals = {}
+    for record in usage_log:
+        key = (record['command'], record['model'])
+        entry = totals.setdefault(key, {"calls": 0, "prompt": 0, "completion": 0, "cost": 0.0, "estimated": False})
+        entry["calls"] += 1
+        entry["prompt"] += record['prompt_tokens']
+        entry["completion"] += record['completion_tokens']
+        entry["cost"] += record['cost'] or 0.0
+        entry["estimated"] = entry["estimated"] or record['estimated']
+
+    console = Console()
+    table = Table(title="Token usage this session")
+    table.add_column("Command", style="cyan", no_wrap=True)
+    table.add_column("Model")
+    table.add_column("Calls", justify="right")
+    table.add_column("Prompt", justify="right")
+    table.add_column("Completion", justify="right")
+    table.add_column("Cost ($)", justify="right")
+
+    # Most expensive workflows first
+    for (command, model), entry in sorted(totals.items(), key=lambda item: -(item[1]["prompt"] + item[1]["completion"])):
+        marker = "~" if entry["estimated"] else ""
+        table.add_row(
+            command, model, str(entry["calls"]),
+            f"{marker}{entry['prompt']}", f"{marker}{entry['completion']}", f"{entry['cost']:.4f}",
+        )
+    console.print(table)
+
+    total_cost = sum(record['cost'] or 0.0 for record in usage_log)
+    print_colored(f"Session total: {get_session_tokens()} tokens, ${total_cost:.4f} (~ marks local estimates)", Fore.CYAN)
+
 def syntax_highlight(code, language):
-    lexer = get_lexer_by_name(language)
-    return highlight(code, lexer, TerminalFormatter())
+    return highlight(code, get_cached_lexer(language), terminal_formatter)
 
 def print_welcome_message():
     print_colored(
@@ -537,6 +1052,7 @@ def print_welcome_message():
 
     table.add_row("/add", "Add files to AI's knowledge base")
     table.add_row("/edit", "Edit existing files")
+    table.add_row("/edit_mode", "Switch /edit between sequential, pipelined and direct")
     table.add_row("/new", "Create new files")
     table.add_row("/search", "Perform a DuckDuckGo search")
     table.add_row("/image", "Add image(s) to AI's knowledge base")
@@ -551,6 +1067,7 @@ def print_welcome_message():
     table.add_row("/model", "Show current AI model")
     table.add_row("/change_model", "Change the AI model")
     table.add_row("/show", "Show content of a file")
+    table.add_row("/usage", "Show token usage and cost per command and model")
     table.add_row("exit", "Exit the application")
 
     console.print(table)
@@ -634,6 +1151,7 @@ async def show_file_content(filepath):
         print(content)
 
 async def main():
+    global current_command
     default_chat_history = [{"role": "system", "content": SYSTEM_PROMPT}]
     editor_chat_history = [{"role": "system", "content": EDITOR_PROMPT}]
     clear_console()
@@ -645,6 +1163,7 @@ async def main():
             prompt = await get_input_async(f"\n\nYou:")
 
             print_files_and_searches_in_memory()
+            current_command = prompt.split()[0] if prompt.startswith("/") else "chat"
 
             if prompt.lower() == "exit":
                 print_colored(
@@ -664,6 +1183,10 @@ async def main():
                 )
                 continue
 
+            if prompt.startswith("/edit_mode"):
+                await handle_edit_mode_command(prompt.split("/edit_mode", 1)[1].strip().lower())
+                continue
+
             if prompt.startswith("/new "):
                 filepaths = prompt.split("/new ", 1)[1].strip().split()
                 default_chat_history, editor_chat_history = await handle_new_command(
@@ -725,6 +1248,10 @@ async def main():
                 await change_model()
                 continue
 
+            if prompt.startswith("/usage"):
+                handle_usage_command()
+                continue
+
             if prompt.startswith("/show "):
                 filepath = prompt.split("/show ", 1)[1].strip()
                 await show_file_content(filepath)
@@ -732,9 +1259,13 @@ async def main():
 
             print_colored("\n🤖 Assistant:", Fore.BLUE)
             try:
+                default_chat_history = refresh_added_files(default_chat_history)
                 default_chat_history.append({"role": "user", "content": prompt})
                 response = get_streaming_response(default_chat_history, DEFAULT_MODEL)
-                default_chat_history.append({"role": "assistant", "content": response})
+                if response:
+                    default_chat_history.append({"role": "assistant", "content": response})
+                else:
+                    default_chat_history.pop()  # Don't resend a refused or failed prompt every turn
             except Exception as e:
                 print_colored(f"Error: {e}. Please try again.", Fore.RED)
 